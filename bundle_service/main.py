@@ -4,30 +4,45 @@ from __future__ import annotations
 import uuid
 from typing import Optional, Any
 
+import orjson
 from fastapi import FastAPI, Header, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
+from starlette.concurrency import run_in_threadpool
 
 import logging
 
-from fhir.resources.bundle import Bundle, BundleEntry, BundleEntryResponse
+from fhir.resources import get_fhir_model_class
+from fhir.resources.bundle import BundleEntry
 from fhir.resources.operationoutcome import OperationOutcome, OperationOutcomeIssue
 
 logger = logging.getLogger(__name__)
 
-valid_resource_types = [
-    "ResearchStudy",
-    "Patient",
-    "ResearchSubject",
-    "Substance",
-    "Specimen",
-    "Observation",
-    "Condition",
-    "Medication",
-    "MedicationAdministration",
-    "DocumentReference",
-    "Task",
-    "FamilyMemberHistory",
-]
+MAX_REQUEST_SIZE = 50 * 1024 * 1024  # 50 MB
+
+VALID_RESOURCE_TYPES = frozenset(
+    {
+        "ResearchStudy",
+        "Patient",
+        "ResearchSubject",
+        "Substance",
+        "Specimen",
+        "Observation",
+        "Condition",
+        "Medication",
+        "MedicationAdministration",
+        "DocumentReference",
+        "Task",
+        "FamilyMemberHistory",
+    }
+)
+
+VALID_ENTRY_METHODS = frozenset({"PUT", "DELETE"})
+
+# model class per supported resource type, resolved once
+resource_classes = {
+    resource_type: get_fhir_model_class(resource_type)
+    for resource_type in VALID_RESOURCE_TYPES
+}
 
 tags_metadata = [
     {
@@ -40,6 +55,75 @@ tags_metadata = [
     },
 ]
 
+
+class FHIRJSONResponse(JSONResponse):
+    """FHIR json response, serialized with orjson."""
+
+    media_type = "application/fhir+json"
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content)
+
+
+post_bundle_openapi_extra = {
+    "requestBody": {
+        "content": {
+            "application/json+fhir": {
+                "schema": {
+                    "type": "object",
+                    "description": """FHIR [Bundle](https://hl7.org/fhir/R5/bundle.html)"""
+                }
+            }
+        }
+    },
+    "responses": {
+        201: {
+            "description": "Created",
+            "content": {
+                "application/json+fhir": {
+                    "schema": {
+                        "type": "object",
+                        "description": "FHIR [Bundle](https://hl7.org/fhir/R5/bundle.html)",
+                    }
+                }
+            },
+        },
+        422: {
+            "description": "Unprocessable Entity",
+            "content": {
+                "application/json+fhir": {
+                    "schema": {
+                        "type": "object",
+                        "description": "FHIR [OperationOutcome](https://hl7.org/fhir/R5/operationoutcome.html) issues that apply to [Bundle](https://hl7.org/fhir/R5/bundle-definitions.html#Bundle.issues) or [Entry](https://hl7.org/fhir/R5/bundle-definitions.html#Bundle.entry.response.outcome)",
+                    }
+                }
+            },
+        },
+        413: {
+            "description": "Payload Too Large",
+            "content": {
+                "application/json+fhir": {
+                    "schema": {
+                        "type": "object",
+                        "description": f"Bundle larger than {MAX_REQUEST_SIZE} bytes",
+                    }
+                }
+            },
+        },
+        401: {
+            "description": "Security Error",
+            "content": {
+                "application/json+fhir": {
+                    "schema": {
+                        "type": "object",
+                        "description": "Authorization header issue",
+                    }
+                }
+            },
+        },
+    }
+}
+
 app = FastAPI(
     title="ACED Submission",
     contact={},
@@ -61,53 +145,7 @@ app = FastAPI(
     # responses={"default": {"model": Any}},
     status_code=201,
     tags=["Submission"],
-    openapi_extra={
-        "requestBody": {
-            "content": {
-                "application/json+fhir": {
-                    "schema": {
-                        "type": "object",
-                        "description": """FHIR [Bundle](https://hl7.org/fhir/R5/bundle.html)"""
-                    }
-                }
-            }
-        },
-        "responses": {
-            201: {
-                "description": "Created",
-                "content": {
-                    "application/json+fhir": {
-                        "schema": {
-                            "type": "object",
-                            "description": "FHIR [Bundle](https://hl7.org/fhir/R5/bundle.html)",
-                        }
-                    }
-                },
-            },
-            422: {
-                "description": "Unprocessable Entity",
-                "content": {
-                    "application/json+fhir": {
-                        "schema": {
-                            "type": "object",
-                            "description": "FHIR [OperationOutcome](https://hl7.org/fhir/R5/operationoutcome.html) issues that apply to [Bundle](https://hl7.org/fhir/R5/bundle-definitions.html#Bundle.issues) or [Entry](https://hl7.org/fhir/R5/bundle-definitions.html#Bundle.entry.response.outcome)",
-                        }
-                    }
-                },
-            },
-            401: {
-                "description": "Security Error",
-                "content": {
-                    "application/json+fhir": {
-                        "schema": {
-                            "type": "object",
-                            "description": "Authorization header issue",
-                        }
-                    }
-                },
-            },
-        }
-    },
+    openapi_extra=post_bundle_openapi_extra,
 )
 async def post__bundle(
     authorization: Optional[str] = Header(None, alias="Authorization"),
@@ -122,175 +160,224 @@ async def post__bundle(
     * See more regarding `use case and validations` [here](https://github.com/ACED-IDP/submission/wiki/Submission).
     """
 
-    body_dict = await body.json()
+    # reject oversize bundles before reading the body
+    content_length = body.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > MAX_REQUEST_SIZE:
+        return too_large_response()
+
+    # chunked requests have no Content-Length, count bytes as they arrive
+    raw_body = bytearray()
+    async for chunk in body.stream():
+        raw_body += chunk
+        if len(raw_body) > MAX_REQUEST_SIZE:
+            return too_large_response()
+    body_dict = orjson.loads(raw_body)
 
     # validate bundle as a whole
     outcome = validate_bundle(body_dict, authorization)
+    security_issue = any(_.code == "security" for _ in outcome.issue)
 
-    # validate each entry in the bundle
-    response_entries = validate_bundle_entries(body_dict)
+    if security_issue:
+        # an unauthorized bundle is rejected as a whole, skip the per entry work
+        response_entries, invalid_count = [], 0
+    else:
+        # validate each entry in the bundle, off the event loop as it is CPU bound
+        response_entries, invalid_count = await run_in_threadpool(validate_bundle_entries, body_dict)
 
     # set status code
     status_code = 201
-    headers = {"Content-Type": "application/fhir+json"}
-    for response_entry in response_entries:
-        if response_entry.response.status != "200":
-            status_code = 422
-            break
+    headers = {}
+    if invalid_count:
+        status_code = 422
     if outcome.issue:
         status_code = 422
-        if len([_.code for _ in outcome.issue if _.code == "security"]):
+        if security_issue:
             status_code = 401
 
     # TODO process each entry in the bundle, save request_bundle
-    response = Bundle(
-        type="transaction-response", entry=response_entries, issues=outcome
-    )
-    response.id = str(uuid.uuid4())
-    Bundle.validate(response)
+    # the response is assembled from server built parts, so it is a plain transaction-response Bundle dict
+    response = transaction_response(outcome, response_entries)
 
     if status_code == 201:
-        headers["Location"] = f"https://aced-idp.org/Bundle/{response.id}"
+        headers["Location"] = f"https://aced-idp.org/Bundle/{response['id']}"
 
-    return JSONResponse(
-        content=response.dict(), status_code=status_code, headers=headers
+    return FHIRJSONResponse(
+        content=response, status_code=status_code, headers=headers
     )
 
 
-def validate_entry(request_entry: BundleEntry) -> OperationOutcomeIssue:
-    """Validate a single entry, return issue or None"""
-    if request_entry.request.method not in ["PUT", "DELETE"]:
-        return OperationOutcomeIssue(
-            severity="error",
-            code="invariant",
-            diagnostics=f"Invalid entry.method {request_entry.request.method} for entry {request_entry.fullUrl}, must be PUT or DELETE",
-        )
-    resource_type = request_entry.resource.resource_type
-    if resource_type not in valid_resource_types:
-        return OperationOutcomeIssue(
-            severity="error",
-            code="invariant",
-            diagnostics=f"Unsupported resource {resource_type}",
+def transaction_response(outcome: OperationOutcome, response_entries: Optional[list[dict]] = None) -> dict:
+    """FHIR transaction-response Bundle, as a dict ready to serialize"""
+    response = {
+        "resourceType": "Bundle",
+        "id": str(uuid.uuid4()),
+        "type": "transaction-response",
+    }
+    if response_entries:
+        response["entry"] = response_entries
+    response["issues"] = outcome.dict()
+    return response
+
+
+def too_large_response() -> FHIRJSONResponse:
+    """Bundle response rejecting a body larger than MAX_REQUEST_SIZE"""
+    outcome = OperationOutcome.construct(
+        issue=[
+            OperationOutcomeIssue.construct(
+                severity="error",
+                code="too-long",
+                diagnostics=f"Bundle exceeds {MAX_REQUEST_SIZE} bytes",
+            )
+        ]
+    )
+    return FHIRJSONResponse(content=transaction_response(outcome), status_code=413)
+
+
+def _entry_issue(severity: str, code: str, diagnostics: str) -> dict:
+    """OperationOutcome.issue of an entry, as a dict ready to serialize"""
+    return {"severity": severity, "code": code, "diagnostics": diagnostics}
+
+
+# issues with fixed diagnostics are only read when serialized so they are shared across entries
+_valid_entry_issue = _entry_issue("success", "success", "Valid entry")
+_missing_identifier_issue = _entry_issue("error", "required", "Resource missing identifier")
+
+
+def _response_entry(status: str, issue: dict) -> dict:
+    """Bundle.entry of a transaction-response, as a dict ready to serialize"""
+    return {
+        "response": {
+            "status": status,
+            "outcome": {"resourceType": "OperationOutcome", "issue": [issue]},
+        }
+    }
+
+
+# every valid entry gets the same response, it is only read when serialized so it is shared
+_ok_response_entry = _response_entry("200", _valid_entry_issue)
+
+
+def validate_entry_fields(entry_dict: dict) -> Optional[dict]:
+    """Validate the raw entry fields that do not need a parsed resource, return issue or None"""
+    if not isinstance(entry_dict, dict):
+        return _entry_issue("error", "structure", f"Invalid entry {entry_dict}, must be an object")
+    request = entry_dict.get("request", None)
+    method = request.get("method", None) if isinstance(request, dict) else None
+    if not isinstance(method, str) or method not in VALID_ENTRY_METHODS:
+        return _entry_issue(
+            "error",
+            "invariant",
+            f"Invalid entry.method {method} for entry {entry_dict.get('fullUrl', None)}, must be PUT or DELETE",
         )
+    resource = entry_dict.get("resource", None)
+    resource_type = resource.get("resourceType", None) if isinstance(resource, dict) else None
+    if not isinstance(resource_type, str) or resource_type not in VALID_RESOURCE_TYPES:
+        return _entry_issue("error", "invariant", f"Unsupported resource {resource_type}")
+    return None
+
+
+def validate_entry(request_entry: BundleEntry) -> dict:
+    """Validate a parsed entry that already passed validate_entry_fields, return issue"""
     if not request_entry.resource.identifier:
-        return OperationOutcomeIssue(
-            severity="error", code="required", diagnostics="Resource missing identifier"
-        )
-    return OperationOutcomeIssue(
-        severity="success",
-        code="success",
-        diagnostics="Valid entry",
-    )
+        return _missing_identifier_issue
+    return _valid_entry_issue
 
 
-def validate_bundle_entries(body: dict) -> list[BundleEntry]:
+def validate_bundle_entries(body: dict) -> tuple[list[dict], int]:
     """Ensure bundle entries are valid for our use case, Messages relating to the processing of individual entries (e.g. in a batch or transaction) SHALL be reported in the entry.response.outcome for that entry.
     https://hl7.org/fhir/R5/bundle-definitions.html#Bundle.issues
-    raise HTTPException if not"""
-
-    response_entries = []
-    request_entries = body.get("entry", [])
-    for entry_dict in request_entries:
-        request_entry = BundleEntry(
-            **entry_dict
-        )  # TODO - this can be invalid, capture issue
-        response_entry = BundleEntry()
-        response_issue = validate_entry(request_entry)
-        if response_issue.severity == "success":
-            response_status = "200"
-        else:
-            response_status = "422"
-        response_entry.response = BundleEntryResponse(status=response_status)
-        response_entry.response.outcome = OperationOutcome(issue=[response_issue])
-        response_entries.append(response_entry)
-
-    return response_entries
+    return the response entries and how many of them are invalid"""
+
+    request_entries = body.get("entry", None) if isinstance(body, dict) else None
+    if not isinstance(request_entries, list):
+        request_entries = []
+    response_entries = [None] * len(request_entries)
+    invalid_count = 0
+    for index, entry_dict in enumerate(request_entries):
+        # cheap checks on the raw dict first, only parse entries that pass them
+        response_issue = validate_entry_fields(entry_dict)
+        if response_issue is None:
+            resource_dict = entry_dict["resource"]
+            try:
+                # validate the entry without its resource, then parse the resource with its own class
+                # rather than resolving it from the polymorphic entry.resource
+                request_entry = BundleEntry.parse_obj(
+                    {key: value for key, value in entry_dict.items() if key != "resource"}
+                ).copy(update={"resource": resource_classes[resource_dict["resourceType"]].parse_obj(resource_dict)})
+            except ValueError as e:
+                response_issue = _entry_issue(
+                    "error", "structure", f"Invalid entry {entry_dict.get('fullUrl', None)}, {e}"
+                )
+            else:
+                response_issue = validate_entry(request_entry)
+        if response_issue["severity"] == "success":
+            response_entries[index] = _ok_response_entry
+            continue
+        invalid_count += 1
+        response_entries[index] = _response_entry("422", response_issue)
+
+    return response_entries, invalid_count
 
 
 def validate_bundle(body: dict, authorization: str) -> OperationOutcome:
     """Ensure bundle is valid for our use case, These issues and warnings must apply to the Bundle as a whole, not to individual entries.
     see https://hl7.org/fhir/R5/bundle-definitions.html#Bundle.issues
     """
-    outcome = OperationOutcome(issue=[])
-    if body is None or body == {}:
-        outcome.issue.append(
-            OperationOutcomeIssue(
-                severity="error",
-                code="required",
-                diagnostics="Bundle missing body",
-            )
-        )
+    issues = []  # (code, diagnostics) of each failed check
+    if not body:
+        issues.append(("required", "Bundle missing body"))
+    elif not isinstance(body, dict):
+        issues.append(("required", f"Body must be a FHIR Bundle, not {type(body).__name__}"))
 
     if authorization is None:
-        outcome.issue.append(
-            OperationOutcomeIssue(
-                severity="error",
-                code="security",
-                diagnostics="Missing Authorization header",
-            )
+        issues.append(("security", "Missing Authorization header"))
+
+    # the remaining checks all read the body as a JSON object
+    if isinstance(body, dict) and body:
+        resource_type, bundle_type, identifier, entry = (
+            body.get("resourceType", None),
+            body.get("type", None),
+            body.get("identifier", None),
+            body.get("entry", None),
         )
 
-    _ = body.get("resourceType", None)
-    if _ != "Bundle":
-        outcome.issue.append(
-            OperationOutcomeIssue(
-                severity="error",
-                code="required",
-                diagnostics=f"Body must be a FHIR Bundle, not {_}",
-            )
-        )
-
-    _ = body.get("type", None)
-    if _ != "transaction":
-        outcome.issue.append(
-            OperationOutcomeIssue(
-                severity="error",
-                code="required",
-                diagnostics=f"Bundle must be of type `transaction`, not {_}",
-            )
-        )
-
-    identifier = body.get("identifier", None)
-    project_id = None
-    if identifier is None:
-        outcome.issue.append(
-            OperationOutcomeIssue(
-                severity="error",
-                code="required",
-                diagnostics="Bundle missing identifier",
-            )
-        )
-
-    if (
-        identifier
-        and identifier.get("system", None) == "https://aced-idp.org/project_id"
-    ):
-        project_id = identifier.get("value", None)
-    if not project_id:
-        outcome.issue.append(
-            OperationOutcomeIssue(
-                severity="error",
-                code="required",
-                diagnostics="Bundle missing identifier https://aced-idp.org/project_id",
-            )
-        )
+        if resource_type != "Bundle":
+            issues.append(("required", f"Body must be a FHIR Bundle, not {resource_type}"))
+
+        if bundle_type != "transaction":
+            issues.append(("required", f"Bundle must be of type `transaction`, not {bundle_type}"))
+
+        project_id = None
+        if identifier is None:
+            issues.append(("required", "Bundle missing identifier"))
+
+        if (
+            isinstance(identifier, dict)
+            and identifier.get("system", None) == "https://aced-idp.org/project_id"
+        ):
+            project_id = identifier.get("value", None)
+        if not project_id:
+            issues.append(("required", "Bundle missing identifier https://aced-idp.org/project_id"))
+
+        if not isinstance(entry, list) or not entry:
+            issues.append(("required", "Bundle missing entry"))
+
+    # the issues are built from constants, skip validating them
+    return OperationOutcome.construct(
+        issue=[
+            OperationOutcomeIssue.construct(severity="error", code=code, diagnostics=diagnostics)
+            for code, diagnostics in issues
+        ]
+    )
 
-    _ = body.get("entry", None)
-    if _ is None or _ == []:
-        outcome.issue.append(
-            OperationOutcomeIssue(
-                severity="error",
-                code="required",
-                diagnostics="Bundle missing entry",
-            )
-        )
 
-    return outcome
+# health checks are polled constantly, serialize their constant body once
+status_response_body = orjson.dumps({"Message": "Feeling good!"})
 
 
 @app.get("/_status", response_model=None, tags=["System"])
-def get__status() -> None:
+def get__status() -> Response:
     """
     Returns if service is healthy or not
     """
-    pass
+    return Response(content=status_response_body, media_type="application/json")
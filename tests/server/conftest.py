@@ -0,0 +1,42 @@
+from typing import AsyncIterator, Iterator
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+from bundle_service.main import app
+
+
+@pytest.fixture(scope="session")
+def client() -> Iterator[TestClient]:
+    """One TestClient, and one app lifespan, for the whole session."""
+    with TestClient(app) as client_:
+        yield client_
+
+
+@pytest.fixture(scope="session")
+def auth_client() -> Iterator[TestClient]:
+    """A session TestClient that sends an Authorization header on every request."""
+    with TestClient(app, headers={"Authorization": "foo"}) as client_:
+        yield client_
+
+
+@pytest.fixture(scope="session")
+def openapi_json(client: TestClient) -> httpx.Response:
+    """The generated schema is static, fetch it once per session."""
+    return client.get("/openapi.json")
+
+
+@pytest.fixture
+def anyio_backend() -> str:
+    """Run async tests on asyncio only."""
+    return "asyncio"
+
+
+@pytest.fixture
+async def async_client() -> AsyncIterator[httpx.AsyncClient]:
+    """An AsyncClient bound to the app, for firing requests concurrently."""
+    async with httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app), base_url="http://testserver"
+    ) as client_:
+        yield client_
@@ -1,64 +1,88 @@
-import copy
+import asyncio
+from types import MappingProxyType
 
-from fastapi.testclient import TestClient
+import orjson
+import pytest
 from requests import Response
 
-from bundle_service.main import app
-
-client = TestClient(app)
+from bundle_service import main
 
 HEADERS = {"Authorization": "foo"}
 
-VALID_CLAIM = {
-    "resourceType": "Claim",
-    "status": "active",
-    "created": "2014-08-16",
-    "use": "claim",
-    "type": {
-        "coding": [
+
+def freeze(value):
+    """Wrap a JSON template in read-only views, so tests cannot mutate it."""
+    if isinstance(value, dict):
+        return MappingProxyType({k: freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+def dumps(value) -> bytes:
+    """Serialize a bundle, expanding any frozen template views."""
+    return orjson.dumps(value, default=dict)
+
+
+VALID_CLAIM = freeze(
+    {
+        "resourceType": "Claim",
+        "status": "active",
+        "created": "2014-08-16",
+        "use": "claim",
+        "type": {
+            "coding": [
+                {
+                    "system": "http://terminology.hl7.org/CodeSystem/claim-type",
+                    "code": "oral",
+                }
+            ]
+        },
+        "patient": {"reference": "Patient/1"},
+    }
+)
+
+VALID_PATIENT = freeze(
+    {
+        "resourceType": "Patient",
+        "identifier": [{"system": "https://example.org/my_id", "value": "test-foo"}],
+    }
+)
+
+VALID_REQUEST_BUNDLE = freeze(
+    {
+        "resourceType": "Bundle",
+        "type": "transaction",
+        "identifier": {
+            "system": "https://aced-idp.org/project_id",
+            "value": "test-foo",
+        },
+        "entry": [
             {
-                "system": "http://terminology.hl7.org/CodeSystem/claim-type",
-                "code": "oral",
+                "resource": None,
+                "request": {"method": "PUT", "url": "Claim"},
             }
-        ]
-    },
-    "patient": {"reference": "Patient/1"},
-}
-
-VALID_PATIENT = {
-    "resourceType": "Patient",
-    "identifier": [{"system": "https://example.org/my_id", "value": "test-foo"}],
-}
-
-VALID_REQUEST_BUNDLE = {
-    "resourceType": "Bundle",
-    "type": "transaction",
-    "identifier": {"system": "https://aced-idp.org/project_id", "value": "test-foo"},
-    "entry": [
-        {
-            "resource": None,
-            "request": {"method": "PUT", "url": "Claim"},
-        }
-    ],
-}
+        ],
+    }
+)
 
 
-def test_read_main():
-    """The main page should return a 404."""
-    response = client.get("/")
-    assert response.status_code == 404, response.status_code
+@pytest.mark.parametrize(
+    "url,status_code",
+    [("/", 404), ("/Bundle", 405), ("/redoc", 200)],
+    ids=["main", "bundle", "openapi_ui"],
+)
+def test_read_status(client, url, status_code):
+    """The main page is missing, GET bundle is not allowed and redoc is served."""
+    response = client.get(url)
+    assert response.status_code == status_code, response.status_code
 
 
-def test_read_health():
+def test_read_health(client):
     """The health page should return a 200."""
     response = client.get("/_status")
     assert response.status_code == 200, response.status_code
-
-
-def test_read_bundle():
-    """A GET bundle page should return a 405."""
-    response = client.get("/Bundle")
-    assert response.status_code == 405, response.status_code
+    assert response.json() == {"Message": "Feeling good!"}, response.json()
 
 
 def assert_bundle_response(
@@ -70,82 +94,110 @@ def assert_bundle_response(
     """Check that a bundle response is valid."""
     assert response.status_code == expected_status_code, response.status_code
     response_bundle = response.json()
-    assert "resourceType" in response_bundle, response_bundle
-    assert response_bundle["resourceType"] == "Bundle", response_bundle
+    assert response_bundle.get("resourceType") == "Bundle", response_bundle
     assert response_bundle["type"] == "transaction-response", response_bundle
-    response_bundle["issues"]["resourceType"] == "OperationOutcome", response_bundle[
-        "issues"
-    ]
-    # print(_)
+    issues = response_bundle["issues"]
+    assert issues["resourceType"] == "OperationOutcome", issues
     if bundle_diagnostic:
-        actual_bundle_diagnostic = sorted(
-            [_["diagnostics"] for _ in response_bundle["issues"]["issue"]]
-        )
+        actual_bundle_diagnostic = {_["diagnostics"] for _ in issues["issue"]}
         assert bundle_diagnostic in actual_bundle_diagnostic, response_bundle
     if entry_diagnostic:
-        actual_entry_diagnostic = sorted(
-            [
-                _["diagnostics"]
-                for _ in response_bundle["entry"][0]["response"]["outcome"]["issue"]
-            ]
-        )
+        actual_entry_diagnostic = {
+            _["diagnostics"]
+            for _ in response_bundle["entry"][0]["response"]["outcome"]["issue"]
+        }
         assert entry_diagnostic in actual_entry_diagnostic, response_bundle
 
 
 def create_request_bundle(
     bundle: dict = VALID_REQUEST_BUNDLE, resource: dict = VALID_PATIENT
 ) -> dict:
-    """create a bundle request."""
-    _ = copy.deepcopy(bundle)
-    _["entry"][0]["resource"] = resource
-    return _
+    """create a bundle request, copying only the layers tests mutate."""
+    entry = bundle["entry"][0]
+    return {
+        **bundle,
+        "entry": [{**entry, "request": {**entry["request"]}, "resource": resource}],
+    }
+
+
+def post_bundle(client, bundle, headers: dict = None) -> Response:
+    """POST a bundle serialized once with orjson rather than httpx's json=."""
+    return client.post(
+        "/Bundle",
+        content=dumps(bundle),
+        headers={**(headers or {}), "Content-Type": "application/json"},
+    )
 
 
-def test_write_bundle_no_data():
-    """A POST bundle without data should return a 422."""
-    response = client.post("/Bundle", json={}, headers=HEADERS)
-    assert_bundle_response(response, 422, bundle_diagnostic="Bundle missing body")
+@pytest.mark.parametrize(
+    "body,headers,status_code,bundle_diagnostic",
+    [
+        ({}, HEADERS, 422, "Bundle missing body"),
+        (None, HEADERS, 422, "Bundle missing body"),
+        ([], HEADERS, 422, "Bundle missing body"),
+        ("x", HEADERS, 422, "Body must be a FHIR Bundle, not str"),
+        ({"resourceType": "Bundle"}, {}, 401, "Missing Authorization header"),
+        ({"resourceType": "Foo"}, HEADERS, 422, "Body must be a FHIR Bundle, not Foo"),
+    ],
+    ids=["no_data", "null_body", "empty_list", "string", "no_auth", "misc_resource"],
+)
+def test_write_bundle_validation(client, body, headers, status_code, bundle_diagnostic):
+    """A POST bundle rejected on body or headers alone should return its diagnostic."""
+    response = post_bundle(client, body, headers=headers)
+    assert_bundle_response(response, status_code, bundle_diagnostic=bundle_diagnostic)
 
 
-def test_write_bundle_no_auth():
-    """A POST bundle with data, but no Auth header should return a 401."""
-    response = client.post("/Bundle", json={"resourceType": "Bundle"})
+def test_write_bundle_no_auth_with_entries(client):
+    """A POST bundle with entries, but no Auth header should return a 401 without entry outcomes."""
+    response = post_bundle(client, create_request_bundle())
     assert_bundle_response(
         response, 401, bundle_diagnostic="Missing Authorization header"
     )
+    assert "entry" not in response.json(), response.json()
 
 
-def test_write_misc_resource():
-    """A POST bundle with data, but not a Bundle should return a 422."""
-    response = client.post("/Bundle", json={"resourceType": "Foo"}, headers=HEADERS)
+def test_write_bundle_too_large(auth_client):
+    """A POST bundle with an oversize Content-Length header alone should return a 413."""
+    response = auth_client.post(
+        "/Bundle",
+        content=iter([b""]),
+        headers={"Content-Length": str(51 * 1024 * 1024)},
+    )
     assert_bundle_response(
-        response, 422, bundle_diagnostic="Body must be a FHIR Bundle, not Foo"
+        response, 413, bundle_diagnostic="Bundle exceeds 52428800 bytes"
     )
 
 
-def test_write_bundle_missing_entry():
+def test_write_bundle_chunked_too_large(auth_client, monkeypatch):
+    """A chunked POST bundle without Content-Length over the limit should return a 413."""
+    monkeypatch.setattr(main, "MAX_REQUEST_SIZE", 1024)
+    response = auth_client.post("/Bundle", content=(b" " * 512 for _ in range(4)))
+    assert_bundle_response(response, 413, bundle_diagnostic="Bundle exceeds 1024 bytes")
+
+
+def test_write_bundle_missing_entry(auth_client):
     """A POST bundle missing `entry` should return a 422."""
     request_bundle = create_request_bundle()
     del request_bundle["entry"]
-    response = client.post("/Bundle", json=request_bundle, headers=HEADERS)
+    response = post_bundle(auth_client, request_bundle)
     assert_bundle_response(response, 422, bundle_diagnostic="Bundle missing entry")
 
     request_bundle = create_request_bundle()
     request_bundle["entry"] = []
-    response = client.post("/Bundle", json=request_bundle, headers=HEADERS)
+    response = post_bundle(auth_client, request_bundle)
     assert_bundle_response(response, 422, bundle_diagnostic="Bundle missing entry")
 
 
-def test_write_bundle_missing_identifier():
+def test_write_bundle_missing_identifier(auth_client):
     """A POST bundle missing `identifier` should return a 422."""
     request_bundle = create_request_bundle()
     del request_bundle["identifier"]
-    response = client.post(url="/Bundle", json=request_bundle, headers=HEADERS)
+    response = post_bundle(auth_client, request_bundle)
     assert_bundle_response(response, 422, bundle_diagnostic="Bundle missing identifier")
 
     request_bundle = create_request_bundle()
     request_bundle["identifier"] = {"system": "https://foo.bar", "value": "foo"}
-    response = client.post(url="/Bundle", json=request_bundle, headers=HEADERS)
+    response = post_bundle(auth_client, request_bundle)
     assert_bundle_response(
         response,
         422,
@@ -153,11 +205,11 @@ def test_write_bundle_missing_identifier():
     )
 
 
-def test_write_bundle_incorrect_method():
+def test_write_bundle_incorrect_method(auth_client):
     """A POST bundle entry without PUT or DELETE should return a 422."""
     request_bundle = create_request_bundle()
     request_bundle["entry"][0]["request"]["method"] = "POST"
-    response = client.post(url="/Bundle", json=request_bundle, headers=HEADERS)
+    response = post_bundle(auth_client, request_bundle)
     assert_bundle_response(
         response,
         422,
@@ -165,45 +217,99 @@ def test_write_bundle_incorrect_method():
     )
 
 
-def test_write_bundle_unsupported_resource():
+def test_write_bundle_missing_request(auth_client):
+    """A POST bundle entry without a request should return a 422."""
+    request_bundle = create_request_bundle()
+    del request_bundle["entry"][0]["request"]
+    response = post_bundle(auth_client, request_bundle)
+    assert_bundle_response(
+        response,
+        422,
+        entry_diagnostic="Invalid entry.method None for entry None, must be PUT or DELETE",
+    )
+
+
+def test_write_bundle_unsupported_resource(auth_client):
     """A POST bundle entry without an unsupported resource should return a 422."""
     request_bundle = create_request_bundle(resource=VALID_CLAIM)
-    import pprint
-
-    pprint.pprint(request_bundle)
-    response = client.post(url="/Bundle", json=request_bundle, headers=HEADERS)
+    response = post_bundle(auth_client, request_bundle)
     assert_bundle_response(response, 422, entry_diagnostic="Unsupported resource Claim")
 
 
-def test_write_bundle_patient_missing_identifier():
+def test_write_bundle_non_object_resource(auth_client):
+    """A POST bundle entry.resource that is not an object should return a 422."""
+    request_bundle = create_request_bundle(resource="Patient")
+    response = post_bundle(auth_client, request_bundle)
+    assert_bundle_response(response, 422, entry_diagnostic="Unsupported resource None")
+
+
+def test_write_bundle_patient_missing_identifier(auth_client):
     """A POST bundle entry.resource without identifier should produce 422."""
     request_bundle = create_request_bundle(resource={"resourceType": "Patient"})
-    response = client.post(url="/Bundle", json=request_bundle, headers=HEADERS)
+    response = post_bundle(auth_client, request_bundle)
     assert_bundle_response(
         response, 422, entry_diagnostic="Resource missing identifier"
     )
 
 
-def test_write_bundle_simple_ok():
+def test_write_bundle_invalid_entry(auth_client):
+    """A POST bundle entry with an unknown field should produce 422."""
+    request_bundle = create_request_bundle()
+    request_bundle["entry"][0]["bogus"] = 1
+    response = post_bundle(auth_client, request_bundle)
+    assert_bundle_response(response, 422)
+    issue = response.json()["entry"][0]["response"]["outcome"]["issue"][0]
+    assert issue["code"] == "structure", issue
+    assert "extra fields not permitted" in issue["diagnostics"], issue
+
+
+def test_write_bundle_invalid_resource(auth_client):
+    """A POST bundle entry.resource that fails its model should produce 422."""
+    request_bundle = create_request_bundle(
+        resource={**VALID_PATIENT, "gender": ["not", "a", "code"]}
+    )
+    response = post_bundle(auth_client, request_bundle)
+    assert_bundle_response(response, 422)
+    issue = response.json()["entry"][0]["response"]["outcome"]["issue"][0]
+    assert issue["code"] == "structure", issue
+
+
+def test_write_bundle_simple_ok(auth_client):
     """A POST bundle without type should produce 201."""
     request_bundle = create_request_bundle()
-    response = client.post(url="/Bundle", json=request_bundle, headers=HEADERS)
+    response = post_bundle(auth_client, request_bundle)
     assert_bundle_response(response, 201)
     response_bundle = response.json()
     assert response_bundle["entry"][0]["response"]["status"] in [
         "200",
         "201",
     ], response_bundle
-    response.headers[
-        "Location"
-    ] == f'https://aced-idp.org/Bundle/{response_bundle["id"]}', "Response header Location should be set to the new Bundle ID"
+    assert (
+        response.headers["Location"]
+        == f'https://aced-idp.org/Bundle/{response_bundle["id"]}'
+    ), "Response header Location should be set to the new Bundle ID"
+
+
+@pytest.mark.anyio
+async def test_write_bundle_concurrent(async_client):
+    """Concurrent POST bundles should each produce 201."""
+    content = dumps(create_request_bundle())
+    responses = await asyncio.gather(
+        *(
+            async_client.post("/Bundle", content=content, headers=HEADERS)
+            for _ in range(10)
+        )
+    )
+    for response in responses:
+        assert_bundle_response(response, 201)
+    assert len({response.json()["id"] for response in responses}) == 10
 
 
-def test_write_bundle_missing_type():
+def test_write_bundle_missing_type(auth_client):
     """A POST bundle without type should produce 422."""
     request_bundle = create_request_bundle()
     del request_bundle["type"]
-    response = client.post(url="/Bundle", json=request_bundle, headers=HEADERS)
+    response = post_bundle(auth_client, request_bundle)
     assert_bundle_response(
         response,
         422,
@@ -211,12 +317,7 @@ def test_write_bundle_missing_type():
     )
 
 
-def test_openapi_ui():
-    response = client.get(url="/redoc")
-    assert response.status_code == 200, response.status_code
-
-
-def test_openapi_json():
-    response = client.get(url="/openapi.json")
-    assert response.status_code == 200, response.status_code
-    assert response.json()
+def test_openapi_json(openapi_json):
+    assert openapi_json.status_code == 200, openapi_json.status_code
+    parameters = openapi_json.json()["paths"]["/Bundle"]["post"]["parameters"]
+    assert [_["name"] for _ in parameters] == ["Authorization"], parameters